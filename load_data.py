@@ -1,45 +1,82 @@
 import os
 import numpy as np
-from utils.tools import to_onehot, load_df, create_spectrograms_raw, \
+from utils.tools import to_onehot, load_df, \
                         get_annotations, get_sound_samples, save_df, sensitivity, \
                         specificity, average_score, harmonic_mean, \
-                        matrices, create_stft, mix_up, convert_fft, power_spectrum, arrange_data
+                        matrices, create_stft, mix_up, convert_fft, power_spectrum, arrange_data, \
+                        create_spectrograms_batch, load_np, save_np, mel_spectrogram_tf
+from utils.spectrogram import create_spectrograms_raw # no TensorFlow import, it is loaded by joblib workers
 import progressbar
+import tensorflow as tf
+from joblib import Parallel, delayed
 
 
+# convert 1D data to mel spectrogram in parallel processes, images keep the order of signals
+def mel_parallel(signals, n_mels, n_jobs=-1):
+  images = Parallel(n_jobs=n_jobs, backend='loky', batch_size=32, verbose=1)(
+    delayed(create_spectrograms_raw)(signal, n_mels=n_mels) for signal in signals) # API for convert mel spectrogram. It is in utils/spectrogram.py
+  if len(images) == 0:
+    return np.array(images)
+
+  # shape of the first image decides shape of the whole set: (N, w, h, 1)
+  # images in range of (0, 1) are stored as float16, it halves memory and cached files
+  data = np.empty((len(images),) + images[0].shape, dtype=np.float16)
+  for idx, image in enumerate(images):
+    data[idx] = image
+  return data
+
+# cached mel images depend on the backend: mel_train_data.npy (librosa), mel_tf_train_data.npy (tf)
+def mel_file(args, name):
+  prefix = 'mel_tf_' if args.mel_backend == 'tf' else 'mel_'
+  return os.path.join(args.save_data_dir, prefix + name + '_data.npy')
+
 def load_mel(args, train_data, test_data):
-  image_test_data = []
-  image_train_data = []
+  if args.mel_backend == 'tf':
+    return load_mel_tf(args, train_data, test_data)
 
   # start convert 1D test data to mel spectrogram
   print('\n' + 'Convert test data: ...')
-  p_te = progressbar.ProgressBar(maxval=len(test_data), widgets=[progressbar.Bar('=', '[', ']'), ' ', progressbar.Percentage()])
-  p_te.start()
-  for idx_te, te in enumerate(test_data):
-      p_te.update(idx_te+1)
-      if len(image_test_data) == 0:
-          image_test_data = create_spectrograms_raw(te, n_mels=args.image_length) # API for convert mel spectrogram. It is in utils/tool.py
-      else:
-          image_test_data = np.concatenate((image_test_data, create_spectrograms_raw(te, n_mels=args.image_length)), axis=0)
-  p_te.finish()
+  image_test_data = mel_parallel(test_data, args.image_length, n_jobs=args.n_jobs)
 
   # start convert 1D train data to mel spectrogram
   print('\n' + 'Convert train data: ...')
-  p_tra = progressbar.ProgressBar(maxval=len(train_data), widgets=[progressbar.Bar('=', '[', ']'), ' ', progressbar.Percentage()])
-  p_tra.start()      
-  for idx_tra, tra in enumerate(train_data):
-      p_tra.update(idx_tra+1)
-      if len(image_train_data) == 0:
-          image_train_data = create_spectrograms_raw(tra, n_mels=args.image_length)
-      else:
-          image_train_data = np.concatenate((image_train_data, create_spectrograms_raw(tra, n_mels=args.image_length)), axis=0)
-  p_tra.finish()
+  image_train_data = mel_parallel(train_data, args.image_length, n_jobs=args.n_jobs)
+
+  # save test and train data
+  save_np(image_test_data, mel_file(args, 'test'))
+  save_np(image_train_data, mel_file(args, 'train'))
+  return image_train_data, image_test_data
+
+def load_mel_tf(args, train_data, test_data):
+  # all signals are padded/truncated to fft_length and converted batch by batch with tf.signal (on GPU if available)
+  print('\n' + 'Convert test data: ...')
+  image_test_data = create_spectrograms_batch(test_data, length=args.fft_length, n_mels=args.image_length)
+  print('\n' + 'Convert train data: ...')
+  image_train_data = create_spectrograms_batch(train_data, length=args.fft_length, n_mels=args.image_length)
 
   # save test and train data
-  save_df(image_test_data, os.path.join(args.save_data_dir, 'mel_test_data.pkz'))
-  save_df(image_train_data, os.path.join(args.save_data_dir, 'mel_train_data.pkz'))
+  save_np(image_test_data, mel_file(args, 'test'))
+  save_np(image_train_data, mel_file(args, 'train'))
   return image_train_data, image_test_data
 
+def mel_dataset(args, signals, labels, shuffle=False):
+  # mel spectrogram is computed in the tf.data pipeline while training, nothing is cached
+  # signals are kept as a ragged tensor and padded/truncated to fft_length one by one
+  signals = tf.RaggedTensor.from_row_lengths(np.concatenate(signals).astype(np.float32), [len(signal) for signal in signals])
+  ds = tf.data.Dataset.from_tensor_slices((signals, labels))
+  if shuffle:
+    ds = ds.shuffle(len(labels))
+
+  def to_image(signal, label):
+    signal = signal[:args.fft_length]
+    signal = tf.pad(signal, [[0, args.fft_length - tf.shape(signal)[0]]])
+    signal = tf.ensure_shape(signal, [args.fft_length]) # static length, so the image size is known when tracing
+    image = mel_spectrogram_tf(signal, length=args.fft_length, n_mels=args.image_length)
+    return image[..., tf.newaxis], label # shape: (w, h, 1)
+
+  ds = ds.map(to_image, num_parallel_calls=tf.data.AUTOTUNE)
+  return ds.batch(args.batch_size).prefetch(tf.data.AUTOTUNE)
+
 def load_stft(args, train_data, test_data):
   image_test_data = []
   image_train_data = []
@@ -50,10 +87,11 @@ def load_stft(args, train_data, test_data):
   p_te.start()
   for idx_te, te in enumerate(test_data):
       p_te.update(idx_te+1)
-      if len(image_test_data) == 0:
-          image_test_data = create_stft(te)
-      else:
-          image_test_data = np.concatenate((image_test_data, create_stft(te)), axis=0)
+      image = create_stft(te)
+      if idx_te == 0:
+          # shape of the first image decides shape of the whole set: (N, w, h, 1)
+          image_test_data = np.empty((len(test_data),) + image.shape, dtype=np.float16)
+      image_test_data[idx_te] = image
   p_te.finish()
 
   # start convert 1D train data to stft
@@ -62,13 +100,13 @@ def load_stft(args, train_data, test_data):
   p_tra.start()      
   for idx_tra, tra in enumerate(train_data):
       p_tra.update(idx_tra+1)
-      if len(image_train_data) == 0:
-          image_train_data = create_stft(tra)
-      else:
-          image_train_data = np.concatenate((image_train_data, create_stft(tra)), axis=0)
+      image = create_stft(tra)
+      if idx_tra == 0:
+          image_train_data = np.empty((len(train_data),) + image.shape, dtype=np.float16)
+      image_train_data[idx_tra] = image
   p_tra.finish()
 
   # save stft-form data
-  save_df(image_test_data, os.path.join(args.save_data_dir, 'stft_test_data.pkz'))
-  save_df(image_train_data, os.path.join(args.save_data_dir, 'stft_train_data.pkz'))
+  save_np(image_test_data, os.path.join(args.save_data_dir, 'stft_test_data.npy'))
+  save_np(image_train_data, os.path.join(args.save_data_dir, 'stft_train_data.npy'))
   return image_train_data, image_test_data
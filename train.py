@@ -16,8 +16,9 @@ from sklearn.model_selection import train_test_split
 from utils.tools import to_onehot, load_df, create_spectrograms_raw, \
                         get_annotations, get_sound_samples, save_df, sensitivity, \
                         specificity, average_score, harmonic_mean, \
-                        matrices, create_stft, mix_up, convert_fft, power_spectrum, arrange_data
-from load_data import load_mel, load_stft
+                        matrices, create_stft, mix_up, convert_fft, power_spectrum, arrange_data, \
+                        load_np, save_np, ICBHIScore, to_object_array
+from load_data import load_mel, load_stft, mel_dataset, mel_file
 from sklearn.metrics import confusion_matrix, accuracy_score, ConfusionMatrixDisplay
 import progressbar
 
@@ -40,6 +41,9 @@ parser.add_argument('--predict', type=bool, default=False, help='predict mode')
 
 parser.add_argument('--based_image', type=str, default='mel', help='mel_stft, stft, mel')
 parser.add_argument('--type_1D', type=str, default=None, help='raw, PSD')
+parser.add_argument('--mel_backend', type=str, default='librosa', help='librosa, tf (batched mel spectrogram on GPU)')
+parser.add_argument('--on_the_fly', type=bool, default=False, help='compute mel spectrogram in tf.data pipeline instead of caching images (mel, models without 1D input)')
+parser.add_argument('--n_jobs', type=int, default=-1, help='number of processes converting mel spectrogram (librosa), -1: all CPUs')
 args = parser.parse_args()
 
 def train(args):
@@ -53,12 +57,7 @@ def train(args):
     else:
         # Load file names 
         print('\n' + '-'*10 + 'CATAGORIZE DATA' + '-'*10)
-        files_name = []
-        for i in os.listdir(args.data_dir):
-            tail = i.split('.')[-1]
-            head = i.split('.')[0]
-            if tail == 'wav':
-                files_name.append(head)
+        files_name = [os.path.splitext(e.name)[0] for e in os.scandir(args.data_dir) if e.name.endswith('.wav')]
 
         # label (before onehot): normal, crackles, wheezes, both = 0, 1, 2, 3
         labels_data = {0: [], 1: [], 2: [], 3: []}
@@ -74,29 +73,21 @@ def train(args):
         test_label = []
         train_data = []
         train_label = []
-        for name in labels_data:
-            all_data = labels_data[name]
-            label = [name]*len(all_data)
-            all_label = np.array([to_onehot(i) for i in label]) # convert label to one-hot type
-            
-            X_train, X_test, y_train, y_test = train_test_split(all_data, all_label, test_size=0.2, random_state=42) 
-            
-            # gather data for train set
-            if train_data == []:
-                train_data = X_train
-                train_label = y_train
-            else:
-                train_data = np.concatenate((train_data, X_train))
-                train_label = np.concatenate((train_label, y_train))
-            
-            # gather data for test set
-            if test_data == []:
-                test_data = X_test
-                test_label = y_test
-            else:
-                test_data = np.concatenate((test_data, X_test))
-                test_label = np.concatenate((test_label, y_test))
-        
+        for name, chunks in labels_data.items():
+            X_train, X_test, y_train, y_test = train_test_split(chunks, np.full(len(chunks), name, dtype=np.int64), test_size=0.2, random_state=42)
+
+            # gather data of each label, arrays are built once after the loop
+            train_data.extend(X_train)
+            train_label.extend(y_train)
+            test_data.extend(X_test)
+            test_label.extend(y_test)
+
+        # signals have different lengths, they are kept in 1D object arrays
+        train_data = to_object_array(train_data)
+        test_data = to_object_array(test_data)
+        train_label = np.eye(4, dtype=np.float32)[np.array(train_label)] # convert label to one-hot type
+        test_label = np.eye(4, dtype=np.float32)[np.array(test_label)]
+
         # save splitted data
         save_df(test_data, os.path.join(args.save_data_dir, 'test_data.pkz'))
         save_df(test_label, os.path.join(args.save_data_dir, 'test_label.pkz'))
@@ -105,33 +96,42 @@ def train(args):
         print('\n' + '-'*10 + 'SAVED DATA' + '-'*10)
     
     ######################## PREPROCESSING DATA ##################################################################
-    if args.based_image == 'mel': # convert raw data to mel spectrogram
-      if os.path.exists(os.path.join(args.save_data_dir, 'mel_test_data.pkz')):
+    # mel spectrogram in tf.data pipeline: only for mel images and models without 1D input
+    on_the_fly = args.based_image == 'mel' and args.on_the_fly and args.type_1D is None
+    if on_the_fly:
+      # mel spectrogram is computed in tf.data pipeline during training/predicting, no cached images
+      train_dataset = mel_dataset(args, train_data, train_label.astype(np.float32), shuffle=True)
+      test_dataset = mel_dataset(args, test_data, test_label.astype(np.float32))
+      print(f'\nShape of mel train data: {train_dataset.element_spec[0].shape} \t {train_label.shape}')
+      print(f'Shape of mel test data: {test_dataset.element_spec[0].shape} \t {test_label.shape}\n')
+
+    elif args.based_image == 'mel': # convert raw data to mel spectrogram
+      if os.path.exists(mel_file(args, 'test')):
         # Load mel spectrogram data, if they exist
-        image_test_data = load_df(os.path.join(args.save_data_dir, 'mel_test_data.pkz'))
-        image_train_data = load_df(os.path.join(args.save_data_dir, 'mel_train_data.pkz'))
+        image_test_data = load_np(mel_file(args, 'test'))
+        image_train_data = load_np(mel_file(args, 'train'))
       else:
         image_train_data, image_test_data = load_mel(args, train_data, test_data)
       print(f'\nShape of mel train data: {image_train_data.shape} \t {train_label.shape}')
       print(f'Shape of mel test data: {image_test_data.shape} \t {test_label.shape}\n')
     
     elif args.based_image == 'stft':
-      if os.path.exists(os.path.join(args.save_data_dir, 'stft_test_data.pkz')):
+      if os.path.exists(os.path.join(args.save_data_dir, 'stft_test_data.npy')):
         # Load stft data, if they exist
-        image_test_data = load_df(os.path.join(args.save_data_dir, 'stft_test_data.pkz'))
-        image_train_data = load_df(os.path.join(args.save_data_dir, 'stft_train_data.pkz'))
+        image_test_data = load_np(os.path.join(args.save_data_dir, 'stft_test_data.npy'))
+        image_train_data = load_np(os.path.join(args.save_data_dir, 'stft_train_data.npy'))
       else:
         image_train_data, image_test_data = load_stft(args, train_data, test_data)
       print(f'\nShape of stft train data: {image_train_data.shape} \t {train_label.shape}')
       print(f'Shape of stft test data: {image_test_data.shape} \t {test_label.shape}\n')
       
     else:
-      if os.path.exists(os.path.join(args.save_data_dir, 'mel_test_data.pkz')):
+      if os.path.exists(mel_file(args, 'test')):
         # Load both mel, stft spectrogram data, if they exist
-        mel_image_test_data = load_df(os.path.join(args.save_data_dir, 'mel_test_data.pkz'))
-        mel_image_train_data = load_df(os.path.join(args.save_data_dir, 'mel_train_data.pkz'))
-        stft_image_test_data = load_df(os.path.join(args.save_data_dir, 'stft_test_data.pkz'))
-        stft_image_train_data = load_df(os.path.join(args.save_data_dir, 'stft_train_data.pkz'))
+        mel_image_test_data = load_np(mel_file(args, 'test'))
+        mel_image_train_data = load_np(mel_file(args, 'train'))
+        stft_image_test_data = load_np(os.path.join(args.save_data_dir, 'stft_test_data.npy'))
+        stft_image_train_data = load_np(os.path.join(args.save_data_dir, 'stft_train_data.npy'))
       else:
         mel_image_train_data, mel_image_test_data = load_mel(args, train_data, test_data)
         stft_image_train_data, stft_image_test_data = load_stft(args, train_data, test_data)
@@ -149,46 +149,48 @@ def train(args):
     # ---------------------------------1D data process------------------------------------
     if args.type_1D == 'PSD':
       print('1D data in PSD form' + '-'*10)
-      if os.path.exists(os.path.join(args.save_data_dir, 'train_fft.pkz')):
-        train_fft = load_df(os.path.join(args.save_data_dir, 'train_fft.pkz'))
-        test_fft = load_df(os.path.join(args.save_data_dir, 'test_fft.pkz'))
+      if os.path.exists(os.path.join(args.save_data_dir, 'train_fft.npy')):
+        train_fft = load_np(os.path.join(args.save_data_dir, 'train_fft.npy'))
+        test_fft = load_np(os.path.join(args.save_data_dir, 'test_fft.npy'))
         train_fft = train_fft[:, :args.fft_length//2, :]
         test_fft = test_fft[:, :args.fft_length//2, :]
       else:
         train_fft = power_spectrum(train_data, num=args.fft_length)
         test_fft = power_spectrum(test_data, num=args.fft_length)
-        save_df(train_fft, os.path.join(args.save_data_dir, 'train_fft.pkz'))
-        save_df(test_fft, os.path.join(args.save_data_dir, 'test_fft.pkz'))
+        save_np(train_fft, os.path.join(args.save_data_dir, 'train_fft.npy'))
+        save_np(test_fft, os.path.join(args.save_data_dir, 'test_fft.npy'))
       print(f'\nShape of 1D training data{train_fft.shape}')
       print(f'Shape of 1D test data{test_fft.shape}\n')
       
     if args.type_1D == 'raw':
       print('1D data in raw form' + '-'*10)
-      if os.path.exists(os.path.join(args.save_data_dir, 'train_raw.pkz')):
-        train_fft = load_df(os.path.join(args.save_data_dir, 'train_raw.pkz'))
-        test_fft = load_df(os.path.join(args.save_data_dir, 'test_raw.pkz'))
+      if os.path.exists(os.path.join(args.save_data_dir, 'train_raw.npy')):
+        train_fft = load_np(os.path.join(args.save_data_dir, 'train_raw.npy'))
+        test_fft = load_np(os.path.join(args.save_data_dir, 'test_raw.npy'))
       else:
         train_fft = arrange_data(train_data, num=args.fft_length)
         test_fft = arrange_data(test_data, num=args.fft_length)
-        save_df(train_fft, os.path.join(args.save_data_dir, 'train_raw.pkz'))
-        save_df(test_fft, os.path.join(args.save_data_dir, 'test_raw.pkz'))
+        save_np(train_fft, os.path.join(args.save_data_dir, 'train_raw.npy'))
+        save_np(test_fft, os.path.join(args.save_data_dir, 'test_raw.npy'))
       print(f'\nShape of 1D training data{train_fft.shape}')
       print(f'Shape of 1D test data{test_fft.shape}\n')
   
     #-------------------------- MIXUP --------------------------------------------------------------------
-    if args.type_1D != None:
-      train_ds = (image_train_data, train_fft, train_label)
-    if args.based_image == 'mel_stft':
-      train_ds = (mel_image_train_data, stft_image_train_data, train_label)
-      
-    images_org_1, ffts_org_1, labels_org_1 = mix_up(train_ds, args, have_normal=False)
-    images_org_2, ffts_org_2, labels_org_2 = mix_up(train_ds, args, have_normal=True)
-    images_org = np.concatenate((images_org_1, images_org_2), axis=0)
-    ffts_org = np.concatenate((ffts_org_1, ffts_org_2), axis=0)
-    labels_org = np.concatenate((labels_org_1, labels_org_2), axis=0)
+    # mixup is only used by models with two inputs
+    if args.type_1D is not None or args.based_image == 'mel_stft':
+      if args.type_1D is not None:
+        train_ds = (image_train_data, train_fft, train_label)
+      if args.based_image == 'mel_stft':
+        train_ds = (mel_image_train_data, stft_image_train_data, train_label)
+
+      images_org_1, ffts_org_1, labels_org_1 = mix_up(train_ds, args, have_normal=False)
+      images_org_2, ffts_org_2, labels_org_2 = mix_up(train_ds, args, have_normal=True)
+      images_org = np.concatenate((images_org_1, images_org_2), axis=0)
+      ffts_org = np.concatenate((ffts_org_1, ffts_org_2), axis=0)
+      labels_org = np.concatenate((labels_org_1, labels_org_2), axis=0)
 
 
-    print(f'\nShape of 1D MIXUP training data: {images_org.shape}, {ffts_org.shape}, {labels_org.shape}\n')
+      print(f'\nShape of 1D MIXUP training data: {images_org.shape}, {ffts_org.shape}, {labels_org.shape}\n')
     # load neural network model
     if args.model_name == 'EfficientNetV2M':
       model = EfficientNetV2M(args.image_length, True)
@@ -214,7 +216,7 @@ def train(args):
     # tf.keras.optimizers.RMSprop(1e-4)
     model.compile(optimizer=tf.keras.optimizers.RMSprop(1e-4), 
                   loss=tf.keras.losses.LogCosh(reduction=tf.keras.losses.Reduction.SUM), 
-                  metrics=['acc', sensitivity, specificity, average_score, harmonic_mean]) 
+                  metrics=['acc', ICBHIScore()])
     model.summary()
     callback = tf.keras.callbacks.EarlyStopping(monitor='val_acc', patience=1)
     if args.train:
@@ -230,6 +232,12 @@ def train(args):
                             epochs     = args.epochs,
                             batch_size = args.batch_size,
                             validation_data = ([mel_image_test_data, stft_image_test_data], test_label),
+#                             callbacks=[callback]
+                            )
+      elif on_the_fly:
+        history = model.fit(train_dataset,
+                            epochs     = args.epochs,
+                            validation_data = test_dataset,
 #                             callbacks=[callback]
                             )
       else:
@@ -270,6 +278,8 @@ def train(args):
           pred_label = model.predict([image_test_data, test_fft])
         elif args.model_name == 'Model_2D2D':
           pred_label = model.predict([mel_image_test_data, stft_image_test_data])
+        elif on_the_fly:
+          pred_label = model.predict(test_dataset)
         else:
           pred_label = model.predict(image_test_data)
         
@@ -0,0 +1,48 @@
+# librosa/NumPy spectrogram helpers without TensorFlow imports:
+# joblib workers in load_data.mel_parallel import only this module
+import functools
+import numpy as np
+import librosa
+
+
+# Same as librosa.power_to_db(S, ref=np.max) followed by scaling to range of (0, 1)
+# With ref=np.max the highest value is 0 dB and the lowest is clipped to -top_db,
+# so the scaling range is known from S.min(), S.max() without scanning the dB image again
+def power_to_db_scaled(S, amin=1e-10, top_db=80.):
+    S = np.asarray(S)
+    ref = max(S.max(), amin)
+    db_min = max(10. * np.log10(max(S.min(), amin) / ref), -top_db)
+    img = np.maximum(S, amin)
+    img /= ref
+    np.log10(img, out=img)
+    img *= 10.
+    np.maximum(img, db_min, out=img)
+    img -= db_min
+    img /= max(-db_min, 1e-12)
+    return img
+
+# mel filterbank is built once for each configuration
+@functools.lru_cache(maxsize=None)
+def mel_filters(sample_rate=4000, nfft=2048, n_mels=224, f_min=50, f_max=4000):
+    return librosa.filters.mel(sr=sample_rate, n_fft=nfft, n_mels=n_mels, fmin=f_min, fmax=f_max)
+
+# Convert 1D-raw data to image by mel spectrogram
+# w, h: width, height
+# width = n_mels = 224
+def create_spectrograms_raw(current_window, sample_rate=4000, n_mels=224, f_min=50, f_max=4000, nfft=2048, hop=6): # increase hop -> decrease height of image
+    current_window = np.array(current_window)
+    # number of frames (center=True): h = 1 + len//hop
+    # smallest hop in hop, hop+2, ... with h <= w = n_mels (solved without computing mel spectrogram)
+    min_hop = len(current_window)//n_mels + 1
+    if min_hop > hop:
+      hop += int(np.ceil((min_hop - hop)/2))*2 # change hop to change height of image
+    S = mel_filters(sample_rate, nfft, n_mels, f_min, f_max) @ (np.abs(librosa.stft(current_window, n_fft=nfft, hop_length=hop))**2) # same as librosa.feature.melspectrogram
+    img = power_to_db_scaled(S) # scale image to range of (0, 1)
+    w, h = img.shape
+
+    if h < w:  # Padding zeros if height < width
+      need = w-h
+      l = need//2
+      img = np.pad(img, ((0, 0), (l, need - l)), mode='constant')
+
+    return img[..., np.newaxis] # add depth dimension, shape: (w, h, 1)
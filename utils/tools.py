@@ -2,18 +2,20 @@ import numpy as np
 import os
 import io
 import math
+import functools
 import random
 import pandas as pd
 import tensorflow as tf
 import matplotlib.pyplot as plt
 import librosa
+import soundfile as sf
 import cv2
 from sklearn.preprocessing import StandardScaler
-from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics import confusion_matrix, accuracy_score
 
 import pickle as pkl
 from keras import backend as K
+from utils.spectrogram import power_to_db_scaled, mel_filters, create_spectrograms_raw
 
 
 # load data from start time to end time in each audio file
@@ -37,11 +39,8 @@ def get_label(crackle, wheeze):
 # read .txt file to get annotations
 def get_annotations(file_name, data_dir):
   # file_name: .txt file
-  f = open(os.path.join(data_dir, file_name), "r")
-  f1 = [i[:-1] for i in list(f)]
-  annotations = np.array([i.split('\t') for i in f1], dtype=np.float32)
-  f.close()
-  return annotations
+  # each row: [start, end, crackles, wheezes], ndmin=2 keeps files with one row in the same shape
+  return np.loadtxt(os.path.join(data_dir, file_name), dtype=np.float32, ndmin=2)
 
 # label consists of its data
 # for example: ['0': [...], '1': [...], '2': [...], '3': [...]]
@@ -52,7 +51,12 @@ def get_sound_samples(labels_data, annotations, file_name, data_dir, sample_rate
     sample_data = [file_name]
     
     # load file with specified sample rate (also converts to mono)
-    data, rate = librosa.load(os.path.join(data_dir, file_name), sr=sample_rate)
+    data, rate = sf.read(os.path.join(data_dir, file_name), dtype='float32', always_2d=False)
+    if data.ndim > 1:
+        data = data.mean(axis=1)
+    if rate != sample_rate:
+        data = librosa.resample(data, orig_sr=rate, target_sr=sample_rate, res_type='polyphase')
+        rate = sample_rate
 
     for row in annotations:
         # get annotations informations
@@ -75,84 +79,101 @@ def load_df(pkz_file):
 # save .pkz file
 def save_df(df, out_file):
   with open(out_file, 'wb') as pfile:
-    pkl.dump(df, pfile, protocol=4)
+    pkl.dump(df, pfile, protocol=pkl.HIGHEST_PROTOCOL)
     print('{0} saved'.format(out_file))
 
+# load .npy file (memory-mapped: data is read from disk when it is used)
+def load_np(npy_file, mmap_mode='r'):
+    return np.load(npy_file, mmap_mode=mmap_mode)
+
+# save .npy file
+def save_np(data, out_file):
+  np.save(out_file, data)
+  print('{0} saved'.format(out_file))
+
+# keep signals of different lengths in a 1D object array
+def to_object_array(signals):
+    data = np.empty(len(signals), dtype=object)
+    for idx, signal in enumerate(signals):
+        data[idx] = signal
+    return data
+
 # convert labels to one-hot type
 def to_onehot(x, num=4):
-    a = np.zeros((num, ))
-    a[x] = 1
-    return a.tolist()
+    return np.eye(num)[x]
 
 # Convert 1D-raw data to image by stft
 # w, h: width, height
 # width = fft_length/2 = 224
 def create_stft(current_window, frame_length=255, frame_step=100, fft_length=224*2): # increase hop -> decrease height of image
+    # number of frames: w = 1 + (len - frame_length)//frame_step, h = fft_length//2 + 1
+    # search frame_step, frame_step-2, ... for the first w >= h, then step back by 2 (solved without computing stft)
+    max_step = (len(current_window) - frame_length)//(fft_length//2) # largest frame_step with w >= h
+    if max_step < frame_step:
+      frame_step -= int(np.ceil((frame_step - max_step)/2))*2 # change frame_step to change height of image
+    frame_step = max(2, frame_step + 2)
     S = tf.signal.stft(current_window, frame_length=frame_length, frame_step=frame_step, fft_length=fft_length)
-    w, h = S.shape
-    frame_step = frame_step
-    while h > w:
-      frame_step -= 2 # change frame_step to change height of image
-      S = tf.signal.stft(current_window, frame_length=frame_length, frame_step=frame_step, fft_length=fft_length)
-      w, h = S.shape
-
-    frame_step += 2
-    S = tf.signal.stft(current_window, frame_length=frame_length, frame_step=frame_step, fft_length=fft_length)
-    S = librosa.power_to_db(S, ref=np.max)
-    w, h = S.shape
-    img = (S-S.min()) / (S.max() - S.min()) # scale image to range of (0, 1) 
+    img = power_to_db_scaled(np.abs(S)) # scale image to range of (0, 1)
+    w, h = img.shape
 
     if w < h:  # Padding zeros if height < width
       need = h-w
       l = need//2
-      img_zer = np.zeros((h, h))
-      img_zer[l: l+w, :] = img
-      img = img_zer
+      img = np.pad(img, ((l, need - l), (0, 0)), mode='constant')
 
     img = img[:fft_length//2, :fft_length//2]
-    img = np.expand_dims(img, axis=-1) # add depth dimension
-    img = np.expand_dims(img, axis=0) # add first dimention
-    return img # shape: (1, w, h, 1)
-
-# Convert 1D-raw data to image by mel spectrogram
-# w, h: width, height
-# width = n_mels = 224
-def create_spectrograms_raw(current_window, sample_rate=4000, n_mels=224, f_min=50, f_max=4000, nfft=2048, hop=6): # increase hop -> decrease height of image
-    current_window = np.array(current_window)
-    S = librosa.feature.melspectrogram(y=current_window, sr=sample_rate, n_mels=n_mels, fmin=f_min, fmax=f_max, n_fft=nfft, hop_length=hop)
-    w, h = S.shape
-    while h > w:
-      hop += 2 # change hop to change height of image
-      S = librosa.feature.melspectrogram(y=current_window, sr=sample_rate, n_mels=n_mels, fmin=f_min, fmax=f_max, n_fft=nfft, hop_length=hop)
-      w, h = S.shape
-    S = librosa.power_to_db(S, ref=np.max)
-    w, h = S.shape
-    img = (S-S.min()) / (S.max() - S.min()) # scale image to range of (0, 1) 
-
-    if h < w:  # Padding zeros if height < width
-      need = w-h
+    return img[..., np.newaxis] # add depth dimension, shape: (w, h, 1)
+
+# tf mel filterbank (shape: (nfft//2 + 1, n_mels)) is built once for each configuration
+# built eagerly (init_scope) and kept as a NumPy array, so it is also reusable when the first call is traced by tf.data
+@functools.lru_cache(maxsize=None)
+def mel_filters_tf(sample_rate=4000, nfft=2048, n_mels=224, f_min=50, f_max=2000):
+    with tf.init_scope():
+      return tf.signal.linear_to_mel_weight_matrix(num_mel_bins=n_mels, num_spectrogram_bins=nfft//2 + 1, sample_rate=sample_rate,
+                                                   lower_edge_hertz=f_min, upper_edge_hertz=f_max).numpy()
+
+# Convert 1D-raw data to mel spectrogram by tf ops, signals: (..., length) -> images: (..., w, h)
+# Works on one signal (tf.data map) or on a batch; one hop is used for signals of `length`
+# mel filters are limited to the Nyquist frequency (tf.signal does not accept f_max > sample_rate/2)
+def mel_spectrogram_tf(signals, length=64653, sample_rate=4000, n_mels=224, f_min=50, f_max=4000, nfft=2048, top_db=80.):
+    hop = max(1, int(np.ceil(length / n_mels))) # number of frames = ceil(length/hop) <= n_mels
+    mel_matrix = mel_filters_tf(sample_rate, nfft, n_mels, f_min, min(f_max, sample_rate/2))
+    S = tf.signal.stft(signals, frame_length=nfft, frame_step=hop, fft_length=nfft, pad_end=True)
+    S = tf.matmul(tf.square(tf.abs(S)), mel_matrix) # shape: (..., h, w)
+    S = tf.linalg.matrix_transpose(S) # shape: (..., w, h) as librosa
+
+    # power_to_db(S, ref=np.max) and scale each image to range of (0, 1)
+    S = 10. * tf.math.log(tf.maximum(S, 1e-10)) / tf.math.log(10.)
+    S = S - tf.reduce_max(S, axis=(-2, -1), keepdims=True)
+    S = tf.maximum(S, -top_db)
+    S_min = tf.reduce_min(S, axis=(-2, -1), keepdims=True)
+    S_max = tf.reduce_max(S, axis=(-2, -1), keepdims=True)
+    img = (S - S_min) / tf.maximum(S_max - S_min, 1e-12)
+
+    h = img.shape[-1]
+    if h < n_mels:  # Padding zeros if height < width
+      need = n_mels - h
       l = need//2
-      img_zer = np.zeros((w, w))
-      img_zer[:, l: l+h] = img
-      img = img_zer
+      img = tf.pad(img, [[0, 0]]*(len(img.shape) - 1) + [[l, need - l]])
+    return img
 
-    img = np.expand_dims(img, axis=-1) # add depth dimension
-    img = np.expand_dims(img, axis=0) # add first dimention
-    return img # shape: (1, w, h, 1)
+# Convert a batch of 1D-raw data to images by mel spectrogram with tf.signal (runs on GPU if available)
+# All signals are padded/truncated to `length`
+# width = n_mels = 224
+def create_spectrograms_batch(signals, length=64653, sample_rate=4000, n_mels=224, f_min=50, f_max=4000, nfft=2048, batch_size=64, top_db=80.):
+    data = pad_signals(signals, length, dtype=np.float32)
+    images = np.empty((len(signals), n_mels, n_mels, 1), dtype=np.float16)
+    for start in range(0, len(signals), batch_size):
+      img = mel_spectrogram_tf(data[start: start+batch_size], length=length, sample_rate=sample_rate, n_mels=n_mels,
+                               f_min=f_min, f_max=f_max, nfft=nfft, top_db=top_db)
+      images[start: start+batch_size] = img.numpy()[..., np.newaxis]
+    return images # shape: (N, w, h, 1), float16
 
 ############################################################ VALIDATION MATRICES #################################################
 # read ICBHI_data_paper.pdf to understand matrices
 def accuracy_m(y_true, y_pred):
-  correct = 0
-  total = 0
-  for i in range(len(y_true)):
-      act_label = np.argmax(y_true[i]) # act_label = 1 (index)
-      pred_label = np.argmax(y_pred[i]) # pred_label = 1 (index)
-      if(act_label == pred_label):
-          correct += 1
-      total += 1
-  accuracy = (correct/total)
-  return accuracy
+  # act_label, pred_label: indexes of the max values
+  return float((np.argmax(y_true, axis=-1) == np.argmax(y_pred, axis=-1)).mean())
 
 def recall_m(y_true, y_pred):
     true_positives = K.sum(K.round(K.clip(y_true * y_pred, 0, 1)))
@@ -171,49 +192,26 @@ def f1_m(y_true, y_pred):
     recall = recall_m(y_true, y_pred)
     return 2*((precision*recall)/(precision+recall+K.epsilon()))
 
+# test: kept for compatibility, the denominator is counted the same way in train and test
+@tf.function
 def sensitivity(y_true, y_pred, test=False):
-  y_pred = tf.cast(tf.math.argmax(y_pred, axis=-1), dtype=tf.float32)
-  y_true = tf.cast(tf.math.argmax(y_true, axis=-1), dtype=tf.float32)
-
-  numerator = 0.
-  denominator = 0.
-  idx = 0
-  for i in y_true:
-    if i != 0.:
-      numerator += tf.cast(y_true[idx]==y_pred[idx], tf.float32)
-    idx += 1
-
-  numerator = tf.cast(numerator, tf.float32)
-  if tf.where(y_true!=0.).shape[1] == None:
-    return 0.
-  if test:
-    denominator = tf.cast(tf.squeeze(tf.where(y_true!=0.)).shape[0], tf.float32)
-  else:
-    if tf.where(y_true!=0.).shape[1]:
-      denominator = tf.cast(tf.where(y_true!=0.).shape[1], tf.float32)
-  return numerator/denominator
+  y_pred = tf.math.argmax(y_pred, axis=-1)
+  y_true = tf.math.argmax(y_true, axis=-1)
+
+  mask = y_true != 0 # abnormal samples: crackle, wheeze, both
+  numerator = tf.reduce_sum(tf.cast((y_true == y_pred) & mask, tf.float32))
+  denominator = tf.reduce_sum(tf.cast(mask, tf.float32))
+  return numerator/tf.maximum(denominator, 1.)
 
+@tf.function
 def specificity(y_true, y_pred, test=False):
-  y_pred = tf.cast(tf.math.argmax(y_pred, axis=-1), dtype=tf.float32)
-  y_true = tf.cast(tf.math.argmax(y_true, axis=-1), dtype=tf.float32)
-
-  numerator = 0.
-  denominator = 0.
-  idx = 0
-  for i in y_true:
-    if i == 0.:
-      numerator += tf.cast(y_true[idx]==y_pred[idx], tf.float32)
-    idx += 1
-
-  numerator = tf.cast(numerator, tf.float32)
-  if tf.where(y_true==0.).shape[1] == None:
-    return 0.
-  if test:
-    denominator = tf.cast(tf.squeeze(tf.where(y_true==0.)).shape[0], tf.float32)
-  else:
-    if tf.where(y_true==0.).shape[1]:
-      denominator = tf.cast(tf.where(y_true==0.).shape[1], tf.float32)
-  return numerator/denominator
+  y_pred = tf.math.argmax(y_pred, axis=-1)
+  y_true = tf.math.argmax(y_true, axis=-1)
+
+  mask = y_true == 0 # normal samples
+  numerator = tf.reduce_sum(tf.cast((y_true == y_pred) & mask, tf.float32))
+  denominator = tf.reduce_sum(tf.cast(mask, tf.float32))
+  return numerator/tf.maximum(denominator, 1.)
 
 def average_score(y_true, y_pred, test=False):
   se = sensitivity(y_true, y_pred, test=test)
@@ -223,9 +221,36 @@ def average_score(y_true, y_pred, test=False):
 def harmonic_mean(y_true, y_pred, test=False):
   se = sensitivity(y_true, y_pred, test=test)
   sp = specificity(y_true, y_pred, test=test)
-  if se + sp == 0.:
-    return 0.
-  return (2*se*sp)/(se + sp)
+  return tf.math.divide_no_nan(2*se*sp, se + sp)
+
+# sensitivity, specificity, average_score, harmonic_mean as one stateful keras metric
+# counts are accumulated once per batch over all batches of an epoch, result() returns the four scores
+# (keras logs each key of the dict: sensitivity, val_sensitivity, ...)
+class ICBHIScore(tf.keras.metrics.Metric):
+  def __init__(self, name='icbhi_score', **kwargs):
+    super().__init__(name=name, **kwargs)
+    self.correct_abnormal = self.add_weight(name='correct_abnormal', initializer='zeros')
+    self.abnormal = self.add_weight(name='abnormal', initializer='zeros')
+    self.correct_normal = self.add_weight(name='correct_normal', initializer='zeros')
+    self.normal = self.add_weight(name='normal', initializer='zeros')
+
+  def update_state(self, y_true, y_pred, sample_weight=None):
+    y_pred = tf.math.argmax(y_pred, axis=-1)
+    y_true = tf.math.argmax(y_true, axis=-1)
+    correct = y_true == y_pred
+    mask = y_true != 0 # abnormal samples: crackle, wheeze, both
+    self.correct_abnormal.assign_add(tf.reduce_sum(tf.cast(correct & mask, tf.float32)))
+    self.abnormal.assign_add(tf.reduce_sum(tf.cast(mask, tf.float32)))
+    self.correct_normal.assign_add(tf.reduce_sum(tf.cast(correct & ~mask, tf.float32)))
+    self.normal.assign_add(tf.reduce_sum(tf.cast(~mask, tf.float32)))
+
+  def result(self):
+    se = self.correct_abnormal/tf.maximum(self.abnormal, 1.)
+    sp = self.correct_normal/tf.maximum(self.normal, 1.)
+    return {'sensitivity': se,
+            'specificity': sp,
+            'average_score': (se + sp)/2,
+            'harmonic_mean': tf.math.divide_no_nan(2*se*sp, se + sp)}
 
 def matrices(y_true, y_pred):
     SE = sensitivity(y_true, y_pred, True)
@@ -244,11 +269,7 @@ def sample_beta_distribution(size, concentration_0=0.2, concentration_1=0.2):
     return gamma_1_sample / (gamma_1_sample + gamma_2_sample)
 
 def onehot_to(labels):
-  a = []
-  for i in labels:
-    i = i.tolist()
-    a.append(i.index(1))
-  return np.array(a)
+  return np.argmax(np.asarray(labels), axis=-1)
 
 def two_permutation_data(ds, have_normal=False):
   data_1, data_2, label = ds
@@ -258,12 +279,6 @@ def two_permutation_data(ds, have_normal=False):
   else:
     label_idx_1 = {1: [], 2: [], 3: []}  # don't choose normal labels
 
-  data_1_one = []
-  data_2_one = []
-  labels_one = []
-  data_1_two = []
-  data_2_two = []
-  labels_two = []
   np.random.seed(0)
 
   for idx, i in enumerate(number_label):
@@ -280,22 +295,15 @@ def two_permutation_data(ds, have_normal=False):
   min_ = np.min(all_len)
 
   # label 1--------------------------------------------
+  # indexes of each label are gathered, data is taken once after the loop
+  idx_one = []
   for i in label_idx_1.values():
     i = np.random.permutation(list(i))
-    if labels_one == []:
-      labels_one = label[i[:min_]]
-    else:
-      labels_one = np.concatenate((labels_one, label[i[:min_]]), axis=0)
-
-    if data_1_one == []:
-      data_1_one = data_1[i[:min_]]
-    else:
-      data_1_one = np.concatenate((data_1_one, data_1[i[:min_]]), axis=0)
-
-    if data_2_one == []:
-      data_2_one = data_2[i[:min_]]
-    else:
-      data_2_one = np.concatenate((data_2_one, data_2[i[:min_]]), axis=0)
+    idx_one.append(i[:min_])
+  idx_one = np.concatenate(idx_one).astype(np.int64)
+  labels_one = label[idx_one]
+  data_1_one = data_1[idx_one]
+  data_2_one = data_2[idx_one]
 
   # label 2---------------------------------------------
   label_2 = np.random.permutation(list(label_idx_1.keys()))
@@ -303,23 +311,15 @@ def two_permutation_data(ds, have_normal=False):
   for i in label_2:
     label_idx_2[i] = label_idx_1[i]
 
+  idx_two = []
   for i in label_idx_2.values():
     i = np.random.permutation(list(i))
-    if labels_two == []:
-      labels_two = label[i[:min_]]
-    else:
-      labels_two = np.concatenate((labels_two, label[i[:min_]]), axis=0)
-
-    if data_1_two == []:
-      data_1_two = data_1[i[:min_]]
-    else:
-      data_1_two = np.concatenate((data_1_two, data_1[i[:min_]]), axis=0)
+    idx_two.append(i[:min_])
+  idx_two = np.concatenate(idx_two).astype(np.int64)
+  labels_two = label[idx_two]
+  data_1_two = data_1[idx_two]
+  data_2_two = data_2[idx_two]
 
-    if data_2_two == []:
-      data_2_two = data_2[i[:min_]]
-    else:
-      data_2_two = np.concatenate((data_2_two, data_2[i[:min_]]), axis=0)
-  
   ds_one = (data_1_one, data_2_one, labels_one)
   ds_two = (data_1_two, data_2_two, labels_two)
   return ds_one, ds_two
@@ -331,6 +331,11 @@ def mix_up(ds, args, alpha=[0.15, 0.2], batch_size_range=[1024, 1024], have_norm
     images_one, ffts_one, labels_one = ds_one 
     images_two, ffts_two, labels_two = ds_two
 
+    # mixed batches are gathered, then concatenated with the original data once
+    images_mix = [images_org]
+    ffts_mix = [ffts_org]
+    labels_mix = [labels_org]
+
     for idx, batch_size in enumerate(batch_size_range):
       num = int(len(labels_one)/batch_size)
       for i in range(num):
@@ -358,27 +363,39 @@ def mix_up(ds, args, alpha=[0.15, 0.2], batch_size_range=[1024, 1024], have_norm
         ffts   = ffts_one_batch  *x_f + ffts_two_batch  *(1 - x_f)
         labels = labels_one_batch*y_l + labels_two_batch*(1 - y_l)
 
-        images_org = np.concatenate((images_org, images), axis=0)
-        ffts_org = np.concatenate((ffts_org, ffts), axis=0)
-        labels_org = np.concatenate((labels_org, labels), axis=0)
+        images_mix.append(images)
+        ffts_mix.append(ffts)
+        labels_mix.append(labels)
+    images_org = np.concatenate(images_mix, axis=0)
+    ffts_org = np.concatenate(ffts_mix, axis=0)
+    labels_org = np.concatenate(labels_mix, axis=0)
     return images_org, ffts_org, labels_org
 
-def convert_fft(x, n=64653):
-  data_fft = []
-  for i in x:
-    t = np.fft.fft(i, n=n)
-    data_fft.append(abs(t))
+def convert_fft(x, n=64653, batch_size=256):
+  data_fft = np.empty((len(x), n))
+  for start in range(0, len(x), batch_size):
+    fhat = abs(np.fft.rfft(pad_signals(x[start: start+batch_size], n), axis=1))
+    data_fft[start: start+batch_size, :n//2 + 1] = fhat
+    data_fft[start: start+batch_size, n//2 + 1:] = fhat[:, 1: n - n//2][:, ::-1] # |fft| of real signals is symmetric
   return np.expand_dims(data_fft, -1)
 
 ########################## 1D data process ######################################
+# zero-pad/truncate signals to the same length, shape: (N, num)
+def pad_signals(signals, num=64653, dtype=np.float64):
+  data = np.zeros((len(signals), num), dtype=dtype)
+  for idx, signal in enumerate(signals):
+    signal = signal[:num]
+    data[idx, :len(signal)] = signal
+  return data
+
 # --------------------------- raw form --------------------------- 
+# scale each signal to range of (0, 1); signals have different lengths
 def scaler_signal(signals):
   data = []
-  scaler = MinMaxScaler()   
   for signal in signals:
-    sig = scaler.fit_transform(signal.reshape(-1, 1))
-    sig = sig.reshape(-1, )
-    data.append(sig)
+    sig = np.asarray(signal).reshape(-1, )
+    mn, mx = sig.min(), sig.max()
+    data.append((sig - mn) / max(mx - mn, 1e-12))
   return data
 
 def arrange_data(signals, num=64653):
@@ -395,26 +412,21 @@ def arrange_data(signals, num=64653):
   return data
 
 # --------------------------- PSD form --------------------------- 
-def power_spectrum(signals, num = 64653):
-  all_data = []
-  for signal in signals:
-    fhat = np.fft.fft(signal, num) 
-    PSD = (fhat * np.conj(fhat)) /  num
-    PSD = PSD[:num//2]
-    out = np.expand_dims(abs(PSD), axis=-1)
-
-#     scaler = MinMaxScaler()   
-#     out_scaled = scaler.fit_transform(out)
-#     all_data.append(out_scaled)
-    all_data.append(out)
-  return np.array(all_data)
+def power_spectrum(signals, num = 64653, batch_size=256):
+  all_data = np.empty((len(signals), num//2, 1))
+  for start in range(0, len(signals), batch_size):
+    fhat = np.fft.rfft(pad_signals(signals[start: start+batch_size], num), axis=1)[:, :num//2]
+    all_data[start: start+batch_size, :, 0] = (fhat * np.conj(fhat)).real / num
+  return all_data
 
 
+# scale each column of each signal to range of (0, 1)
 def scaler_transform(signals):
   data = []
-  scale = MinMaxScaler()
   for signal in signals:
     if len(signal.shape) < 2:
       signal = np.expand_dims(signal, axis=-1)
-    data.append(scale.fit_transform(signal))
+    mn = signal.min(axis=0, keepdims=True)
+    mx = signal.max(axis=0, keepdims=True)
+    data.append((signal - mn) / np.maximum(mx - mn, 1e-12))
   return np.array(data)